@@ -192,8 +192,10 @@ if __name__ == "__main__":
   urls_by_category = get_lib_locations(f)
   f.close()
 
-  broken_ids = [line.rstrip('\n') for line in open('broken.conf')]
-  skipped_ids = [line.rstrip('\n') for line in open('skipped.conf')]
+  with open('broken.conf') as f:
+    broken_ids = {line.rstrip('\n') for line in f}
+  with open('skipped.conf') as f:
+    skipped_ids = {line.rstrip('\n') for line in f}
 
   contribs_by_id = {}
 
@@ -46,22 +46,52 @@ This script takes two arguments
 If no arguments are passed, it uses the following defaults
   Arg 1: sources.conf
   Arg 2: ../sources/
+
+Pass --compact to write the json without indentation, e.g. for CI pipelines
+that don't need to read it. The default stays indented so that the files in
+version control remain readable and diff well.
 """
 
-from sys import argv
-from urllib.request import urlopen
 from time import localtime, gmtime, strftime
-import re
-import shutil
-import http.client
+from requests.adapters import HTTPAdapter
+import argparse
+import asyncio
+import atexit
+import concurrent.futures
+import requests
+import sqlite3
 import sys
-import json
 import os
 
+# aiohttp is optional, FETCH_ERRORS lists the errors that mean a props file
+# could not be downloaded
+try:
+  import aiohttp
+  FETCH_ERRORS = (IOError, aiohttp.ClientError, asyncio.TimeoutError)
+except ImportError:
+  aiohttp = None
+  FETCH_ERRORS = (IOError,)
+
+# json is written as UTF-8: orjson never escapes non-ASCII characters, so the
+# stdlib fallback doesn't either
+try:
+  import orjson
+
+  def dump_json(obj, compact=False):
+    return orjson.dumps(obj, option=None if compact else orjson.OPT_INDENT_2)
+except ImportError:
+  import json
+
+  def dump_json(obj, compact=False):
+    if compact:
+      return json.dumps(obj, separators=(',', ':'), ensure_ascii=False).encode('utf-8')
+    return json.dumps(obj, indent=2, ensure_ascii=False).encode('utf-8')
+
 class Logger(object):
   def __init__(self):
     self.terminal = sys.stdout
-    self.log = open("build.log", "a")
+    self.log = open("build.log", "a", buffering=65536)
+    atexit.register(self.log.close)
 
   def __getattr__(self, attr):
     return getattr(self.terminal, attr)
@@ -71,37 +101,146 @@ class Logger(object):
     self.log.write(message)  
 
   def flush(self):
-    pass
+    self.terminal.flush()
+    # the log is closed at exit, before the interpreter flushes stdout
+    if not self.log.closed:
+      self.log.flush()
 
 sys.stdout = Logger()
 
-def read_exports(f):
+# most props files live on a handful of hosts, so keep their connections alive
+# and share them between the download threads
+SESSION = requests.Session()
+SESSION.mount('http://', HTTPAdapter(pool_connections=16, pool_maxsize=32))
+SESSION.mount('https://', HTTPAdapter(pool_connections=16, pool_maxsize=32))
+
+# keys from the props files that have a different name in the json
+RENAMES = {'authorList': 'authors', 'category': 'categories', 'compatibleModesList': 'modes'}
+
+def open_props_cache(path):
   """
-  Reads a library's export.txt file and returns a dictionary.
+  Opens the database of previously downloaded props files, creating it if
+  it doesn't exist yet.
   """
-  lines = f.read().decode('utf-8')
-  lines = lines.replace("authorList", "authors").replace("category", "categories").replace("compatibleModesList", "modes")
-  lines = lines.replace('\r\n', '\n').replace('\r', '\n')
-  lines = lines.split('\n')
-  
-  export_table = {}
-  
-  for line in lines:
-    hash = line.find('#')
-    line = line.strip() if hash == -1 else line[:hash]
-    if len(line) == 0:
-      continue
+  os.makedirs(os.path.dirname(path), exist_ok=True)
+  cache = sqlite3.connect(path)
+  cache.execute('CREATE TABLE IF NOT EXISTS props '
+                '(url TEXT PRIMARY KEY, etag TEXT, last_modified TEXT, body BLOB, fetched_at TEXT)')
+  return cache
 
-    equals = line.find('=')
-    if equals == -1:
-      continue
-    
-    attr = line[:equals].strip()
-    val = line[equals+1:].strip()
-    export_table[attr] = val
-  
+def get_cached_props(cache, prop_url):
+  """
+  Returns a (etag, last_modified, body) tuple for the given url, or None if
+  it was never downloaded.
+  """
+  return cache.execute('SELECT etag, last_modified, body FROM props WHERE url = ?',
+                       (prop_url,)).fetchone()
+
+def store_cached_props(cache, prop_url, headers, body):
+  """
+  Remembers a downloaded props file along with its validators, if the server
+  sent any.
+  """
+  etag = headers.get('ETag')
+  last_modified = headers.get('Last-Modified')
+  if etag is None and last_modified is None:
+    return
+  fetched_at = strftime("%a, %d %b %Y %H:%M:%S GMT", gmtime())
+  cache.execute('INSERT OR REPLACE INTO props VALUES (?, ?, ?, ?, ?)',
+                (prop_url, etag, last_modified, body, fetched_at))
+
+def conditional_headers(cached):
+  """
+  Returns the request headers asking to only send a props file if it changed
+  since the cached copy was downloaded.
+  """
+  headers = {}
+  if cached:
+    etag, last_modified, body = cached
+    if etag:
+      headers['If-None-Match'] = etag
+    if last_modified:
+      headers['If-Modified-Since'] = last_modified
+  return headers
+
+def fetch_props(prop_url, cached=None):
+  """
+  Downloads a contribution's properties file and returns a tuple with its raw
+  contents and the response headers. If a cached copy is given, the file is
+  only downloaded when it changed upstream; otherwise the cached contents are
+  returned with None for headers.
+  """
+  response = SESSION.get(prop_url, headers=conditional_headers(cached), timeout=30)
+  if cached and response.status_code == 304:
+    return cached[2], None
+  response.raise_for_status()
+  return response.content, response.headers
+
+async def fetch_props_async(session, semaphore, prop_url, cached=None):
+  """
+  Same as fetch_props, using an aiohttp session.
+  """
+  async with semaphore:
+    async with session.get(prop_url, headers=conditional_headers(cached)) as response:
+      if cached and response.status == 304:
+        return cached[2], None
+      response.raise_for_status()
+      return await response.read(), response.headers
+
+async def fetch_all_props_async(prop_urls, cached):
+  """
+  Same as fetch_all_props, using aiohttp.
+  """
+  # the semaphore keeps queued requests from eating into their own timeout
+  semaphore = asyncio.Semaphore(64)
+  connector = aiohttp.TCPConnector(limit=64)
+  timeout = aiohttp.ClientTimeout(total=30)
+  async with aiohttp.ClientSession(connector=connector, timeout=timeout) as session:
+    return await asyncio.gather(*(fetch_props_async(session, semaphore, prop_url, c)
+                                  for prop_url, c in zip(prop_urls, cached)),
+                                return_exceptions=True)
+
+def fetch_all_props(prop_urls, cached):
+  """
+  Downloads the given props files concurrently, using aiohttp if available
+  and a thread pool otherwise. Returns, in the same order as the urls, either
+  the (contents, headers) tuple from fetch_props or the exception raised.
+  """
+  if aiohttp is not None:
+    return asyncio.run(fetch_all_props_async(prop_urls, cached))
+
+  results = []
+  with concurrent.futures.ThreadPoolExecutor(max_workers=32) as executor:
+    futures = [executor.submit(fetch_props, prop_url, c) for prop_url, c in zip(prop_urls, cached)]
+    for future in futures:
+      try:
+        results.append(future.result())
+      except Exception as inst:
+        results.append(inst)
+  return results
+
+def read_exports(data):
+  """
+  Reads the contents of a library's export.txt file and returns a dictionary.
+  Decoding is strict: a file that isn't valid UTF-8 is reported rather than
+  listed with replacement characters in its name.
+  """
+  text = data.decode('utf-8').replace('\r\n', '\n').replace('\r', '\n')
+
+  export_table = {}
+  for line in text.split('\n'):
+    attr, equals, val = line.partition('#')[0].partition('=')
+    if equals:
+      attr = attr.strip()
+      export_table[RENAMES.get(attr, attr)] = val.strip()
   return export_table
 
+# keys that describe the java package rather than the contribution itself
+PACKAGE_KEYS = ('minRevision', 'maxRevision', 'props', 'download')
+
+# keys that aren't part of the json format
+REMOVED_KEYS = ('version', 'prettyVersion')
+
 def format_exports(exports):
   """
   Update the dictionary to the new format
@@ -110,45 +249,43 @@ def format_exports(exports):
     exports['authors'] = [exports['authors']]
 
   if 'categories' in exports and exports['categories']:
-    categories = exports['categories'].split(',')
-    for cat in categories:
-      cat.strip()
-    exports['categories'] = categories
+    exports['categories'] = [c.strip() for c in exports['categories'].split(',') if c.strip()]
   else:
     exports['categories'] = None
   
-  package_java = { }
-  package_java['mode'] = 'java'
-  package_keys = ['minRevision', 'maxRevision', 'props', 'download']
-  for key in package_keys:
-    if key in exports:
-      package_java[key] = exports[key]
-      exports.pop(key)
-
+  package_java = {'mode': 'java', **{key: exports.pop(key) for key in PACKAGE_KEYS if key in exports}}
   exports['packages'] = [ package_java ]
 
-  remove_keys = ['version', 'prettyVersion']
-  for key in remove_keys:
-    if key in exports:
-      exports.pop(key)
+  for key in REMOVED_KEYS:
+    exports.pop(key, None)
 
   return exports
 
-def write_exports(dirout, exports):
+# drops characters that aren't allowed in file names and replaces spaces
+SANITIZE = str.maketrans('', '', '\\/:*?"<>|\0' + ''.join(map(chr, range(32))))
+SANITIZE[ord(' ')] = '_'
+
+def write_exports(dirout, exports, compact=False):
   """
-  Writes the given dictionary to a json file
+  Writes the given dictionary to a json file, unless the file already has
+  the same contents. Returns the path of the file. The json is indented
+  unless compact is set.
   """
-  
-  blacklist = ["\\", "/", ":", "*", "?", "\"", "<", ">", "|", "\0"]
-  filename = exports['name'].strip()
-  filename = "".join(c for c in filename if c not in blacklist)
-  filename = "".join(c for c in filename if 31 < ord(c))
-  filename = filename.replace(' ', '_')
+  filename = exports['name'].strip().translate(SANITIZE)
 
   filepath = os.path.join(dirout, filename + '.json')
   print('export ' + exports['packages'][0]['props'] + ' to ' + filepath)
-  with open(filepath, 'w') as outfile:
-    json.dump(exports, outfile, indent=2)
+  data = dump_json(exports, compact)
+  try:
+    with open(filepath, 'rb') as infile:
+      if infile.read() == data:
+        return filepath
+  except FileNotFoundError:
+    pass
+
+  with open(filepath, 'wb', buffering=131072) as outfile:
+    outfile.write(data)
+  return filepath
 
 def get_lib_locations(f):
   """
@@ -159,10 +296,9 @@ def get_lib_locations(f):
   software_type = None
   category = None
   urls_by_category = {}
-  for line in f.readlines():
-    hash = line.find('#')
-    line = line.strip() if hash == -1 else line[:hash]
-    if len(line) == 0:
+  for line in f:
+    line = line.partition('#')[0].strip()
+    if not line:
       continue
 
     if line[0] == '[' and line[-1] == ']':
@@ -196,119 +332,162 @@ def get_lib_locations(f):
 
   return urls_by_category
 
+# keys every props file needs to provide to be listed
+REQUIRED_KEYS = ('name', 'authors', 'url', 'categories', 'sentence', 'version')
+
 def missing_key(exports):
-  keys = list(exports.keys())
-  required_keys = ['name', 'authors', 'url', 'categories', 'sentence', 'version']
-  for key in required_keys:
-    if not keys.count(key):
+  for key in REQUIRED_KEYS:
+    if key not in exports:
       return key
   return None
 
 if __name__ == "__main__":
-  if len(argv) == 1:
-    script = argv
-    conf = 'sources.conf'
-    dirout = '../sources/'
-    minrev = 228
-    maxrev = 0
-  elif len(argv) == 3:
-    script, conf, dirout = argv
-    minrev = 228
-    maxrev = 0
-  elif len(argv) == 5:
-    script, conf, dirout, minrev, maxrev = argv
-  else:
-    print("Usage is [Input File] [Output Dir] [Min Revision] [Max Revision]")
-    exit()
-
-  if (int(maxrev) != 0 and int(maxrev) < 228):
+  parser = argparse.ArgumentParser()
+  parser.add_argument('conf', nargs='?', default='sources.conf', help="config file to read from")
+  parser.add_argument('dirout', nargs='?', default='../sources/', help="folder to write to")
+  parser.add_argument('minrev', nargs='?', type=int, default=228, help="min revision")
+  parser.add_argument('maxrev', nargs='?', type=int, default=0, help="max revision")
+  parser.add_argument('--compact', action='store_true', help="write the json without indentation")
+  args = parser.parse_args()
+  conf, dirout, minrev, maxrev = args.conf, args.dirout, args.minrev, args.maxrev
+
+  if (maxrev != 0 and maxrev < 228):
     print("Incompatible maxrev! This script is only for Processing 3.x. Please use build_listing_legacy.py instead.")
     exit()
   
   print("----- " + strftime("%a %d %b %Y %H:%M:%S", localtime()) + " -----")
 
-  f = open(conf)
-  urls_by_category = get_lib_locations(f)
-  f.close()
-
-  broken_ids = [line.rstrip('\n') for line in open('broken.conf')]
-  skipped_ids = [line.rstrip('\n') for line in open('skipped.conf')]
+  with open(conf, 'r', encoding='utf-8') as f:
+    urls_by_category = get_lib_locations(f)
 
-  contribs_by_id = {}
+  with open('broken.conf') as f:
+    broken_ids = {line.rstrip('\n') for line in f}
+  with open('skipped.conf') as f:
+    skipped_ids = {line.rstrip('\n') for line in f}
 
+  # gather every contribution up front so that the downloads can overlap
+  contribs = []
   for cat in urls_by_category:
-    contribs = urls_by_category[cat]
-
-    for contrib in contribs:
-      software_type, contrib_id, prop_url = contrib
-
+    for software_type, contrib_id, prop_url in urls_by_category[cat]:
       if (contrib_id in skipped_ids):
         print("Skipping " + contrib_id)
         continue
+      contribs.append((software_type, contrib_id, prop_url, cat))
+
+  contribs_by_id = {}
+
+  cache = open_props_cache(os.path.join('cache', 'props.sqlite'))
+
+  # contributions listed in several categories are only downloaded once
+  prop_urls = list(dict.fromkeys(prop_url for _, _, prop_url, _ in contribs))
+  for prop_url in prop_urls:
+    print("Opening " + prop_url)
+  cached = [get_cached_props(cache, prop_url) for prop_url in prop_urls]
+  results_by_url = dict(zip(prop_urls, fetch_all_props(prop_urls, cached)))
+  exports_by_url = {}
+
+  # results are merged in .conf order so that the output stays stable
+  for software_type, contrib_id, prop_url, cat in contribs:
+    download_url = prop_url[:prop_url.rfind('.')] + '.zip'
+    try:
+      if prop_url in exports_by_url:
+        # the values are all strings, so a shallow copy is enough
+        exports = dict(exports_by_url[prop_url])
+      else:
+        result = results_by_url[prop_url]
+        if isinstance(result, Exception):
+          raise result
+        data, headers = result
+        if headers is not None:
+          store_cached_props(cache, prop_url, headers, data)
+        exports = read_exports(data)
+        exports_by_url[prop_url] = dict(exports)
+
+      exports['id'] = contrib_id
+      exports['type'] = software_type
+
+      exports['props'] = prop_url
+
+      # overwrite the category with what was in the .conf file
+      exports['categories'] = cat
+      
+      # set default compatible strings if none found
+      if (not 'minRevision' in exports or exports['minRevision'] == ''):
+        exports['minRevision'] = '0'
+      # if (not 'maxRevision' in exports or exports['maxRevision'] == ''):
+      #   if (contrib_id in broken_ids):
+      #     exports['maxRevision'] = '228'
+      #   else:
+      #     exports['maxRevision'] = '0'
+      if (contrib_id in broken_ids):
+          exports['maxRevision'] = '228'
+      else:
+        if (not 'maxRevision' in exports or exports['maxRevision'] == ''):
+          exports['maxRevision'] = '0'
 
-      download_url = prop_url[:prop_url.rfind('.')] + '.zip'
+      key = missing_key(exports)
+      if key:
+        print("Error reading " + prop_url)
+        print("  No value for '%s'. Maybe it's a 404 page" % key)
+        continue
+      # if no download is explicitly provided, use the default download url
+      if not any(key.startswith('download') for key in exports):
+        exports['download'] = download_url
+
+      # add the contribution if it's compatible with the revision number
+      # only parse the revisions of the bounds that are set
+      compatible = True
       try:
-        print("Opening " + prop_url)
-        exports = read_exports(urlopen(prop_url))
-
-        exports['id'] = contrib_id
-        exports['type'] = software_type
-
-        exports['props'] = prop_url
-
-        # overwrite the category with what was in the .conf file
-        exports['categories'] = cat
-        
-        # set default compatible strings if none found
-        if (not 'minRevision' in exports or exports['minRevision'] == ''):
-          exports['minRevision'] = '0'
-        # if (not 'maxRevision' in exports or exports['maxRevision'] == ''):
-        #   if (contrib_id in broken_ids):
-        #     exports['maxRevision'] = '228'
-        #   else:
-        #     exports['maxRevision'] = '0'
-        if (contrib_id in broken_ids):
-            exports['maxRevision'] = '228'
-        else:
-          if (not 'maxRevision' in exports or exports['maxRevision'] == ''):
-            exports['maxRevision'] = '0'
-
-        key = missing_key(exports)
-        if key:
-          print("Error reading " + prop_url)
-          print("  No value for '%s'. Maybe it's a 404 page" % key)
-          continue
-        # if no download is explicitly provided, use the default download url
-        m = re.compile('download.*')
-        if len([x for x in exports if m.match(x)]) == 0:
-          exports['download'] = download_url
-
-        # add the contribution if it's compatible with the revision number
-        if ((int(minrev) == 0 or int(exports['maxRevision']) == 0 or int(minrev) <= int(exports['maxRevision'])) and 
-            (int(maxrev) == 0 or int(exports['minRevision']) == 0 or int(maxrev) >= int(exports['minRevision']))):
-          if contrib_id not in contribs_by_id:
-            # add the new contribution to the list
-            contribs_by_id[contrib_id] = exports
-          else:
-            # append the category to the existing contribution
-            contribs_by_id[contrib_id]['categories'] += "," + cat
-
-      except IOError as inst:
+        if minrev != 0:
+          ex_max = int(exports['maxRevision'])
+          compatible = ex_max == 0 or minrev <= ex_max
+        if compatible and maxrev != 0:
+          ex_min = int(exports['minRevision'])
+          compatible = ex_min == 0 or maxrev >= ex_min
+      except ValueError as inst:
         print("Error reading " + prop_url)
-        print(inst)
-        
-      except UnicodeDecodeError as inst:
-        print("Error decoding " + prop_url)
-        print(inst)
-
-  # create empty output dir
-  if os.path.exists(dirout) and os.path.isdir(dirout):
-    shutil.rmtree(dirout)
-  if not os.path.exists(dirout):
-    os.makedirs(dirout)
+        print("  Invalid revision number: %s" % inst)
+        continue
+      if compatible:
+        if contrib_id not in contribs_by_id:
+          # add the new contribution to the list
+          contribs_by_id[contrib_id] = exports
+        else:
+          # append the category to the existing contribution
+          contribs_by_id[contrib_id]['categories'] += "," + cat
+
+    except FETCH_ERRORS as inst:
+      print("Error reading " + prop_url)
+      print(inst)
+      
+    except UnicodeDecodeError as inst:
+      print("Error decoding " + prop_url)
+      print(inst)
+
+  cache.commit()
+  cache.close()
+
+  # create the output dir, existing files are updated in place
+  os.makedirs(dirout, exist_ok=True)
 
   # write all contributions out to files
+  written_filenames = set()
+  written_files = set()
   for contrib_id in contribs_by_id:
     contribs_by_id[contrib_id] = format_exports(contribs_by_id[contrib_id])
-    write_exports(dirout, contribs_by_id[contrib_id])
+    filepath = write_exports(dirout, contribs_by_id[contrib_id], args.compact)
+    written_filenames.add(os.path.basename(filepath))
+    stat = os.stat(filepath)
+    written_files.add((stat.st_dev, stat.st_ino))
+
+  # remove the files of contributions that are no longer listed. Files are
+  # matched by identity too, since on case-insensitive file systems a renamed
+  # contribution (Foo -> FOO) is written into the existing file (Foo.json)
+  with os.scandir(dirout) as entries:
+    for entry in entries:
+      if entry.name.endswith('.json') and entry.name not in written_filenames and entry.is_file():
+        stat = os.stat(entry.path)
+        if (stat.st_dev, stat.st_ino) not in written_files:
+          print('remove ' + entry.path)
+          os.unlink(entry.path)
 